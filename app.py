@@ -1,12 +1,34 @@
-from flask import Flask, request, jsonify
+# Patch blocking I/O for gevent workers before anything else is imported
+from gevent import monkey
+monkey.patch_all()
+
+import pymysql
+pymysql.install_as_MySQLdb()
+
+from flask import Flask, Response, request, jsonify
 from flask_sqlalchemy import SQLAlchemy
 from flask_cors import CORS
-from flask_restx import Api, Resource, fields
+from flask_restx import Api, Resource, fields, marshal
+from sqlalchemy import bindparam, text
+from sqlalchemy.exc import OperationalError
+from sqlalchemy.pool import QueuePool
+from service_streamer import ThreadedStreamer
+from werkzeug.exceptions import HTTPException
+from werkzeug.http import quote_etag
+from tenacity import retry, retry_if_exception_type, stop_after_attempt, wait_exponential
+from cachetools import TTLCache
+import orjson
 import requests
+from requests.adapters import HTTPAdapter
+import hashlib
+import hmac
 import logging
 import os
+import threading
+from operator import itemgetter
 from datetime import datetime
 from secrets_manager import get_service_secrets
+from semantic_cache import SemanticCache
 
 # Configure logging
 logging.basicConfig(level=logging.INFO, 
@@ -15,7 +37,7 @@ logging.basicConfig(level=logging.INFO,
 
 app = Flask(__name__)
 CORS(app)
-app.config['DEBUG'] = True
+app.config['DEBUG'] = False
 
 # Configure API
 api = Api(app,
@@ -37,15 +59,50 @@ SQLALCHEMY_DATABASE_URI = (
 )
 app.config['SQLALCHEMY_DATABASE_URI'] = SQLALCHEMY_DATABASE_URI
 app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
+# Reuse MySQL connections across requests; pre-ping drops ones closed by wait_timeout.
+# Per worker process, so keep workers * (pool_size + max_overflow) well under
+# max_connections, which is shared with the content processor
+app.config['SQLALCHEMY_ENGINE_OPTIONS'] = {
+    'poolclass': QueuePool,
+    'pool_size': 5,
+    'max_overflow': 5,
+    'pool_timeout': 30,
+    'pool_recycle': 1800,
+    'pool_pre_ping': True
+}
 
 API_KEY = secrets.get('API_KEY')
 EMBEDDING_API_URL = secrets.get('EMBEDDING_API_URL')
+# (connect, read) timeouts for embedding service calls; batch calls must finish,
+# retries included, within the streamer's 20s wait in predict()
+EMBEDDING_API_TIMEOUT = (2, 8)
+# The query embedding only feeds the semantic cache, so give up on it quickly
+EMBED_QUERY_TIMEOUT = (1, 2)
+
+# Keep-alive connections to the embedding service shared across requests;
+# retries are handled by retry_rpc rather than the adapter
+http_session = requests.Session()
+http_adapter = HTTPAdapter(pool_connections=20, pool_maxsize=50)
+http_session.mount('http://', http_adapter)
+http_session.mount('https://', http_adapter)
 
 db = SQLAlchemy(app)
 
+# Cache of similarity results for near-duplicate queries
+semantic_cache = SemanticCache(maxsize=1024, ttl=300, threshold=0.85)
+
+# Per-user embedding_id -> chunk_id maps; new chunks only arrive with new uploads
+embedding_map_cache = TTLCache(maxsize=10_000, ttl=60)
+embedding_map_cache_lock = threading.Lock()
+
+# Marshalled content responses and their ETags; content rarely changes after upload
+content_cache = TTLCache(maxsize=1024, ttl=300)
+content_cache_lock = threading.Lock()
+
 # Define database models (same as content processor)
 class Content(db.Model):
     __tablename__ = 'content'
+    __table_args__ = (db.Index('ix_content_user', 'user_id'),)
     id = db.Column(db.Integer, primary_key=True, autoincrement=True)
     user_id = db.Column(db.Integer, nullable=False)
     file_name = db.Column(db.String(255), nullable=False)
@@ -66,12 +123,27 @@ class Content(db.Model):
 
 class ContentChunk(db.Model):
     __tablename__ = 'content_chunk'
+    __table_args__ = (db.Index('ix_chunk_content_emb', 'content_id', 'embedding_id'),)
     id = db.Column(db.Integer, primary_key=True, autoincrement=True)
     content_id = db.Column(db.Integer, db.ForeignKey('content.id'))
     chunk_order = db.Column(db.Integer, nullable=False)
     chunk_text = db.Column(db.Text, nullable=False)
     embedding_id = db.Column(db.Integer)
 
+# Search path statements, built once instead of per request
+EMBEDDING_MAP_SQL = text("""
+SELECT cc.id, cc.embedding_id
+FROM content_chunk cc JOIN content c ON cc.content_id = c.id
+WHERE c.user_id = :uid AND cc.embedding_id IS NOT NULL
+  AND (:cid IS NULL OR c.id = :cid)
+""")
+
+CHUNK_DETAILS_SQL = text("""
+SELECT cc.id, cc.chunk_text, cc.content_id, c.file_name
+FROM content_chunk cc JOIN content c ON cc.content_id = c.id
+WHERE cc.id IN :chunk_ids
+""").bindparams(bindparam('chunk_ids', expanding=True))
+
 # API Models
 search_response = api.model('SearchResponse', {
     'message': fields.String,
@@ -108,6 +180,110 @@ chunk_response = api.model('ChunkResponse', {
     'embedding_id': fields.Integer
 })
 
+def rollback_session(retry_state):
+    """Reset the session after a failed query so it can be retried"""
+    db.session.rollback()
+
+# Retry transient failures with backoff; the last error is re-raised to the caller
+retry_db = retry(
+    retry=retry_if_exception_type(OperationalError),
+    stop=stop_after_attempt(3),
+    wait=wait_exponential(multiplier=0.1, max=1),
+    before_sleep=rollback_session,
+    reraise=True
+)
+# Only failures to connect (including ConnectTimeout) are retried; a read timeout
+# means the embedding service is already busy with the request
+retry_rpc = retry(
+    retry=retry_if_exception_type(requests.ConnectionError),
+    stop=stop_after_attempt(3),
+    wait=wait_exponential(multiplier=0.1, max=1),
+    reraise=True
+)
+
+def post_embedding_api(path, headers, payload, timeout=EMBEDDING_API_TIMEOUT):
+    """POST a JSON payload to the embedding service"""
+    return http_session.post(
+        f'{EMBEDDING_API_URL}{path}',
+        headers=headers,
+        json=payload,
+        timeout=timeout
+    )
+
+def embed_query(query_text, headers):
+    """Get the embedding vector of the query text, or None if unavailable"""
+    try:
+        response = post_embedding_api(
+            '/api/embedding/embed',
+            headers,
+            {'text': query_text},
+            timeout=EMBED_QUERY_TIMEOUT
+        )
+        if response.status_code != 200:
+            logging.warning(f"Failed to embed query: {response.status_code}")
+            return None
+        return response.json()['embedding']
+    except Exception as e:
+        logging.warning(f"Failed to embed query: {str(e)}")
+        return None
+
+def similar_embeddings_batch(queries):
+    """Get similar embeddings for a batch of queries in a single request"""
+    try:
+        response = retry_rpc(post_embedding_api)(
+            '/api/embedding/similar/batch',
+            {'X-API-KEY': API_KEY},
+            {'queries': queries}
+        )
+        if response.status_code != 200:
+            logging.error(f"Failed to get similar embeddings batch: {response.status_code}")
+            return [None] * len(queries)
+
+        # The streamer thread indexes one result per query and dies on a mismatch
+        results = response.json()['results']
+        if not isinstance(results, list) or len(results) != len(queries):
+            logging.error("Similar embeddings batch returned a malformed result list")
+            return [None] * len(queries)
+        return results
+    except Exception as e:
+        logging.error(f"Failed to get similar embeddings batch: {str(e)}")
+        return [None] * len(queries)
+
+# Collects concurrent similarity queries for up to 10ms and sends them as one batch
+embedding_streamer = ThreadedStreamer(similar_embeddings_batch, batch_size=32, max_latency=0.01)
+
+@retry_db
+def get_embedding_map(user_id, content_id=None):
+    """Get the embedding_id -> chunk_id mapping for a user's content"""
+    key = (user_id, content_id)
+    with embedding_map_cache_lock:
+        cached = embedding_map_cache.get(key)
+    if cached is not None:
+        return cached
+
+    # If content_id provided, only search within that content
+    embedding_chunks = db.session.execute(
+        EMBEDDING_MAP_SQL,
+        {'uid': user_id, 'cid': content_id or None}
+    ).all()
+
+    embedding_to_chunk = {ec[1]: ec[0] for ec in embedding_chunks}
+
+    with embedding_map_cache_lock:
+        embedding_map_cache[key] = embedding_to_chunk
+    return embedding_to_chunk
+
+@retry_db
+def get_chunks_by_id(chunk_ids):
+    """Get chunk details with their file names, keyed by chunk ID"""
+    chunks = db.session.execute(CHUNK_DETAILS_SQL, {'chunk_ids': chunk_ids}).all()
+
+    return {chunk.id: chunk for chunk in chunks}
+
+def json_response(payload, status=200):
+    """Serialize a response with orjson, bypassing flask_restx marshalling"""
+    return Response(orjson.dumps(payload), status=status, mimetype='application/json')
+
 @ns.route('/search')
 class SearchResource(Resource):
     @api.doc('search_similar_chunks',
@@ -115,7 +291,7 @@ class SearchResource(Resource):
                     'query': 'Text to search for',
                     'content_id': 'ID of specific content to search within',
                     'limit': 'Number of results to return (default: 5)'})
-    @api.marshal_with(search_response)
+    @api.response(200, 'Success', search_response)
     def get(self):
         """Search for similar chunks across a user's content"""
         user_id = request.args.get('user_id')
@@ -127,136 +303,190 @@ class SearchResource(Resource):
             api.abort(400, "Missing required parameters: user_id and query")
 
         try:
-            # Step 1: Get content IDs to search within
-            content_query = db.session.query(Content.id)\
-                .filter(Content.user_id == user_id)
-            
-            if content_id:
-                # If content_id provided, only search within that content
-                content_query = content_query.filter(Content.id == content_id)
-                
-            content_ids = content_query.all()
-            content_ids = [id[0] for id in content_ids]
-
-            if not content_ids:
-                return {
-                    'message': 'No content found for this user',
-                    'results': []
-                }, 200
+            # Step 1: Get the embedding_id -> chunk_id mapping for the user's content
+            embedding_to_chunk = get_embedding_map(user_id, content_id)
 
-            # Step 2: Get all embedding IDs for the user's content
-            embedding_chunks = db.session.query(ContentChunk.id, ContentChunk.embedding_id)\
-                .filter(ContentChunk.content_id.in_(content_ids))\
-                .filter(ContentChunk.embedding_id.isnot(None))\
-                .all()
-
-            if not embedding_chunks:
-                return {
+            if not embedding_to_chunk:
+                return json_response({
                     'message': 'No embeddings found for this user\'s content',
                     'results': []
-                }, 200
-
-            # Create mapping of embedding_id to chunk_id
-            embedding_to_chunk = {ec[1]: ec[0] for ec in embedding_chunks}
-            embedding_ids = list(embedding_to_chunk.keys())
+                })
 
-            # Step 3: Query embedding service for similar embeddings
+            # Step 2: Query embedding service for similar embeddings
             headers = {'X-API-KEY': API_KEY}
             correlation_id = request.headers.get('X-Correlation-ID')
             if correlation_id:
                 headers['X-Correlation-ID'] = correlation_id
                 
-            response = requests.post(
-                f'{EMBEDDING_API_URL}/api/embedding/similar',
-                headers=headers,
-                json={
+            # Reuse the result of a near-duplicate query when one is cached
+            query_embedding = embed_query(query_text, headers)
+            cache_key = (user_id, content_id, limit)
+            similar_embeddings = None
+            if query_embedding is not None:
+                similar_embeddings = semantic_cache.get(cache_key, query_embedding)
+
+            if similar_embeddings is None:
+                similarity_query = {
                     'text': query_text,
-                    'embedding_ids': embedding_ids,
-                    'limit': limit
+                    'user_id': user_id,
+                    'content_id': content_id,
+                    'limit': limit,
+                    'correlation_id': correlation_id
                 }
-            )
+                if query_embedding is not None:
+                    # Already embedded for the cache lookup; don't embed it again
+                    similarity_query['embedding'] = query_embedding
+                similar_embeddings = embedding_streamer.predict([similarity_query])[0]
 
-            if response.status_code != 200:
-                api.abort(500, "Failed to get similar embeddings")
+                if similar_embeddings is None:
+                    api.abort(500, "Failed to get similar embeddings")
 
-            similar_embeddings = response.json()['similar_embeddings']
+                if query_embedding is not None:
+                    semantic_cache.put(cache_key, query_embedding, similar_embeddings)
 
-            # Step 4: Get the corresponding chunks
+            # Step 3: Get the corresponding chunks, skipping embeddings not yet
+            # in the (cached) mapping
             similar_chunk_ids = [
-                embedding_to_chunk[emb['id']] 
+                embedding_to_chunk[emb['id']]
                 for emb in similar_embeddings
+                if emb['id'] in embedding_to_chunk
             ]
 
-            # Step 5: Get the chunk details
-            similar_chunks = db.session.query(
-                ContentChunk.id,
-                ContentChunk.chunk_text,
-                ContentChunk.content_id,
-                Content.file_name
-            )\
-                .join(Content)\
-                .filter(ContentChunk.id.in_(similar_chunk_ids))\
-                .all()
-
-            # Format results
-            results = [{
-                'chunk_id': chunk.id,
-                'content_id': chunk.content_id,
-                'file_name': chunk.file_name,
-                'text': chunk.chunk_text,
-                'similarity_score': next(
-                    emb['similarity_score'] 
-                    for emb in similar_embeddings 
-                    if embedding_to_chunk[emb['id']] == chunk.id
-                )
-            } for chunk in similar_chunks]
-
-            # Sort by similarity score
-            results.sort(key=lambda x: x['similarity_score'], reverse=True)
-
-            return {
+            # Step 4: Get the chunk details
+            chunk_by_id = get_chunks_by_id(similar_chunk_ids)
+
+            # Format results in similarity order; sort the small embedding list
+            # rather than the result dicts, and copy since it may be cached
+            results = []
+            for emb in sorted(similar_embeddings, key=itemgetter('similarity_score'), reverse=True):
+                chunk = chunk_by_id.get(embedding_to_chunk.get(emb['id']))
+                if chunk is None:
+                    continue
+                results.append({
+                    'chunk_id': chunk.id,
+                    'content_id': chunk.content_id,
+                    'file_name': chunk.file_name,
+                    'text': chunk.chunk_text,
+                    'similarity_score': emb['similarity_score']
+                })
+
+            return json_response({
                 'message': 'Search completed successfully',
                 'results': results
-            }, 200
+            })
 
+        except HTTPException:
+            raise
+        except OperationalError as e:
+            logging.error(f"Database unavailable in search_similar_chunks: {str(e)}")
+            api.abort(503, "Database unavailable")
         except Exception as e:
             logging.error(f"Error in search_similar_chunks: {str(e)}")
             api.abort(500, "Internal server error")
 
+@retry_db
+def get_content(content_id, field_names=None):
+    """Get the marshalled content response and its ETag, or None if not found
+
+    If `field_names` is given, only those content fields are selected and returned.
+    """
+    key = (content_id, field_names)
+    with content_cache_lock:
+        cached = content_cache.get(key)
+    if cached is not None:
+        return cached
+
+    names = field_names or tuple(content_response)
+    columns = [Content.__table__.columns[name] for name in names]
+    content = db.session.query(*columns)\
+        .filter(Content.id == content_id)\
+        .first()
+    if content is None:
+        return None
+
+    data = content._asdict()
+    for date_field in ('upload_date', 'publication_date'):
+        if data.get(date_field):
+            data[date_field] = data[date_field].isoformat()
+    data = marshal(data, {name: content_response[name] for name in names})
+    # Hash the response itself so edits (e.g. chunk_count, title) change the ETag
+    etag = hashlib.md5(orjson.dumps(data)).hexdigest()
+
+    with content_cache_lock:
+        content_cache[key] = (data, etag)
+    return data, etag
+
+@retry_db
+def content_exists(content_id):
+    """Check whether content exists with a single-column primary key read"""
+    return db.session.query(Content.id)\
+        .filter(Content.id == content_id)\
+        .scalar() is not None
+
 @ns.route('/content/<int:content_id>')
 class ContentResource(Resource):
-    @api.doc('get_content_by_id')
-    @api.marshal_with(content_response)
+    @api.doc('get_content_by_id',
+             params={'fields': 'Comma-separated content fields to return (default: all)'})
+    @api.response(200, 'Success', content_response)
+    @api.response(304, 'Not modified')
     def get(self, content_id):
         """Get content by ID"""
+        field_names = request.args.get('fields')
+        if field_names:
+            field_names = tuple(sorted({name.strip() for name in field_names.split(',') if name.strip()}))
+            unknown = [name for name in field_names if name not in content_response]
+            if unknown:
+                api.abort(400, f"Unknown fields: {', '.join(unknown)}")
+        field_names = field_names or None
+
         try:
-            content = Content.query.get(content_id)
+            content = get_content(content_id, field_names)
             if content is None:
                 api.abort(404, "Content not found")
-                
-            return {
-                'id': content.id,
-                'user_id': content.user_id,
-                'file_name': content.file_name,
-                'file_type': content.file_type,
-                'upload_date': content.upload_date.isoformat(),
-                'file_size': content.file_size,
-                's3_key': content.s3_key,
-                'chunk_count': content.chunk_count,
-                'custom_prompt': content.custom_prompt,
-                'title': content.title,
-                'author': content.author,
-                'publication_date': content.publication_date.isoformat() if content.publication_date else None,
-                'publisher': content.publisher,
-                'source_language': content.source_language,
-                'genre': content.genre,
-                'topic': content.topic
-            }, 200
+
+            data, etag = content
+            headers = {'ETag': quote_etag(etag)}
+            if request.if_none_match.contains_weak(etag):
+                return Response(status=304, headers=headers)
+
+            return data, 200, headers
             
+        except HTTPException:
+            raise
+        except OperationalError as e:
+            logging.error(f"Database unavailable in get_content_by_id: {str(e)}")
+            api.abort(503, "Database unavailable")
         except Exception as e:
             logging.error(f"Error in get_content_by_id: {str(e)}")
             api.abort(500, "Internal server error")
 
+    @api.doc('check_content_exists')
+    @api.response(200, 'Content exists')
+    @api.response(404, 'Content not found')
+    def head(self, content_id):
+        """Check whether content exists"""
+        try:
+            if not content_exists(content_id):
+                api.abort(404, "Content not found")
+
+            return Response(status=200)
+
+        except HTTPException:
+            raise
+        except OperationalError as e:
+            logging.error(f"Database unavailable in check_content_exists: {str(e)}")
+            api.abort(503, "Database unavailable")
+        except Exception as e:
+            logging.error(f"Error in check_content_exists: {str(e)}")
+            api.abort(500, "Internal server error")
+
+@retry_db
+def get_chunk(chunk_id):
+    """Get the text and embedding_id of a chunk, or None if not found"""
+    return db.session.query(ContentChunk.chunk_text, ContentChunk.embedding_id)\
+        .filter(ContentChunk.id == chunk_id)\
+        .first()
+
 @ns.route('/chunk/<int:chunk_id>')
 class ChunkResource(Resource):
     @api.doc('get_chunk_text_by_id')
@@ -264,7 +494,7 @@ class ChunkResource(Resource):
     def get(self, chunk_id):
         """Get text and embedding_id of a chunk by ID"""
         try:
-            chunk = ContentChunk.query.get(chunk_id)
+            chunk = get_chunk(chunk_id)
             if chunk is None:
                 api.abort(404, "Chunk not found")
                 
@@ -273,6 +503,11 @@ class ChunkResource(Resource):
                 'embedding_id': chunk.embedding_id
             }, 200
             
+        except HTTPException:
+            raise
+        except OperationalError as e:
+            logging.error(f"Database unavailable in get_chunk_text_by_id: {str(e)}")
+            api.abort(503, "Database unavailable")
         except Exception as e:
             logging.error(f"Error in get_chunk_text_by_id: {str(e)}")
             api.abort(500, "Internal server error")
@@ -283,19 +518,22 @@ def log_request_info():
     if request.path.startswith('/docs') or request.path.startswith('/swagger'):
         return
 
-    logging.info(f"Headers: {request.headers}")
-    logging.info(f"Body: {request.get_data()}")
+    if logging.getLogger().isEnabledFor(logging.DEBUG):
+        logging.debug(f"Headers: {request.headers}")
+        if request.method != 'GET':
+            logging.debug(f"Body: {request.get_data()}")
 
-    if 'X-API-KEY' not in request.headers:
+    x_api_key = request.headers.get('X-API-KEY')
+    if x_api_key is None:
         logging.warning("No X-API-KEY header")
         return jsonify({'error': 'No X-API-KEY'}), 401
     
-    x_api_key = request.headers.get('X-API-KEY')
-    if x_api_key != API_KEY:
+    if not API_KEY or not hmac.compare_digest(x_api_key.encode(), API_KEY.encode()):
         logging.warning("Invalid X-API-KEY")
         return jsonify({'error': 'Invalid X-API-KEY'}), 401
     else:
         return
 
 if __name__ == '__main__':
-    app.run(debug=True, host='0.0.0.0', port=C_PORT)
\ No newline at end of file
+    # Local development only; deployments run under Gunicorn (see gunicorn.conf.py)
+    app.run(host='0.0.0.0', port=C_PORT)
\ No newline at end of file
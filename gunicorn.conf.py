@@ -0,0 +1,10 @@
+from secrets_manager import get_service_secrets
+
+# Same port source as app.py's C_PORT
+bind = f"0.0.0.0:{int(get_service_secrets('gnosis-query').get('PORT', 5000))}"
+
+# Sized for a t2.micro: each worker holds up to 10 MySQL connections (see
+# SQLALCHEMY_ENGINE_OPTIONS) and its own in-process caches
+worker_class = 'gevent'
+workers = 2
+worker_connections = 100
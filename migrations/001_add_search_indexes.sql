@@ -0,0 +1,15 @@
+-- Indexes backing the /api/search embedding map query.
+-- Online DDL: builds in place without blocking reads or writes.
+
+-- Content rows are looked up by owner; InnoDB appends the primary key (id),
+-- so this also covers the content_id filter.
+ALTER TABLE content
+    ADD INDEX ix_content_user (user_id),
+    ALGORITHM=INPLACE, LOCK=NONE;
+
+-- Equality column first, then the IS NOT NULL column; chunk id comes from the
+-- primary key, making this covering for (id, embedding_id). It also satisfies
+-- the content_id foreign key, so MySQL drops the implicit FK index.
+ALTER TABLE content_chunk
+    ADD INDEX ix_chunk_content_emb (content_id, embedding_id),
+    ALGORITHM=INPLACE, LOCK=NONE;
@@ -0,0 +1,72 @@
+import threading
+import time
+
+import numpy as np
+from cachetools import TTLCache
+
+
+class SemanticCache:
+    """Caches similarity results keyed by the embedding of the query text.
+
+    Entries are grouped into buckets (e.g. per user and search scope). A lookup
+    returns the cached result of the closest prior query in the bucket when its
+    cosine similarity exceeds `threshold` and the entry has not expired.
+    """
+
+    def __init__(self, maxsize=1024, ttl=300, threshold=0.85, bucket_size=64):
+        self.ttl = ttl
+        self.threshold = threshold
+        self.bucket_size = bucket_size
+        # Whole buckets are evicted LRU-style once idle for `ttl` seconds
+        self._buckets = TTLCache(maxsize=maxsize, ttl=ttl)
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _normalize(vector):
+        vector = np.asarray(vector, dtype=np.float32)
+        norm = np.linalg.norm(vector)
+        return vector / norm if norm else vector
+
+    def get(self, key, vector):
+        """Return the cached result for a query similar to `vector`, or None"""
+        query = self._normalize(vector)
+        now = time.monotonic()
+
+        with self._lock:
+            bucket = self._buckets.get(key)
+            if bucket is None:
+                return None
+
+            vectors, results, expires = bucket
+            if vectors.shape[1] != query.shape[0]:
+                return None
+
+            scores = vectors @ query
+            scores[np.asarray(expires) <= now] = -1.0
+            best = int(np.argmax(scores))
+            if scores[best] > self.threshold:
+                return results[best]
+            return None
+
+    def put(self, key, vector, result):
+        """Store `result` for the query embedded as `vector`"""
+        query = self._normalize(vector)
+        now = time.monotonic()
+
+        with self._lock:
+            bucket = self._buckets.get(key)
+            if bucket is None or bucket[0].shape[1] != query.shape[0]:
+                vectors, results, expires = np.empty((0, query.shape[0]), dtype=np.float32), [], []
+            else:
+                # Drop expired entries before appending the new one
+                vectors, results, expires = bucket
+                live = [i for i, expiry in enumerate(expires) if expiry > now]
+                vectors = vectors[live]
+                results = [results[i] for i in live]
+                expires = [expires[i] for i in live]
+
+            vectors = np.vstack([vectors, query])[-self.bucket_size:]
+            results = (results + [result])[-self.bucket_size:]
+            expires = (expires + [now + self.ttl])[-self.bucket_size:]
+
+            self._buckets[key] = (vectors, results, expires)